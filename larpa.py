@@ -7,6 +7,14 @@ First-time setup:
   > source .venv/bin/activate
   > pip install -r requirements.txt 
 
+  Optionally, install the SANE bindings so that the OSC server can keep the
+  scanner open between scans instead of running `scanimage` for each one:
+  > sudo apt install libsane-dev
+  > pip install python-sane Pillow
+
+  The OSC server then holds the scanner open for as long as it runs, so stop
+  the server before testing a scan via the CLI.
+
 Activating the Python virtual environment:
   > cd <repo>
   > source .venv/bin/activate
@@ -44,62 +52,435 @@ configured to communicate with the OSC server:
     /scan_and_print
 """
 import argparse
+import asyncio
+import importlib.util
+import logging
+import multiprocessing
+import os
+import shutil
+import signal
+import socket
 import subprocess
-from threading import Lock
+import sys
+import time
+from logging.handlers import QueueHandler, QueueListener
+from threading import Event, Thread
 
 from pythonosc.dispatcher import Dispatcher
-from pythonosc.osc_server import ThreadingOSCUDPServer
-from pythonosc.udp_client import SimpleUDPClient
+from pythonosc.osc_packet import OscPacket, ParseError
+
+try:
+  import sane
+except ImportError:
+  sane = None
 
 DEFAULT_OSC_SERVER_HOST = "0.0.0.0"
 DEFAULT_OSC_SERVER_PORT = 13000
 DEFAULT_OSC_CLIENT_HOST = "127.0.0.1"
 
+# The encoded OSC address and type tag of an /echo message carrying one string,
+# each null-padded to a multiple of four bytes. Only the string itself needs to
+# be encoded per message.
+ECHO_PREFIX = b"/echo\x00\x00\x00,s\x00\x00"
+
+# The UDP socket that echo_handler sends from. Created on first use and reused
+# for every later send to a host of the same address family.
+ECHO_SOCKET = None
+
+# Receive buffer size for the OSC server socket, so that bursts of messages are
+# queued by the kernel rather than dropped. Linux caps this at
+# `/proc/sys/net/core/rmem_max`, which may need raising to take full effect:
+#   > sudo sysctl -w net.core.rmem_max=1048576
+OSC_SERVER_RCVBUF = 1 << 20
+
+# The largest OSC datagram the server will read.
+OSC_MAX_PACKET_SIZE = 1 << 16
+
+# The most datagrams a receiver reads per event loop wake. Anything left is read
+# on the next wake, so a steady flood can't starve scheduled bundle messages.
+OSC_MAX_READS_PER_WAKE = 64
+
+# The number of OSC server processes reading from the server socket. They share
+# one bound socket, so whichever is idle picks up the next datagram.
+OSC_SERVER_RECEIVERS = 2
+
 # The scanner to target. Use `scanimage -L` to list all available devices.
 SCANNER_DEVICE_NAME = "pixma:04A918AA_2067EE"
 
 # The file that the scanner will write to.
 OUT_FILE = "out.jpeg"
 
-# Global lock that ensures that we only attempt to scan/print once-at-a-time.
-MUTEX = Lock()
+# The open SANE scanner device, when the optional SANE bindings are installed.
+# Opened once by the job worker process and reused for every scan.
+SCANNER = None
+
+# Absolute paths to the scan and print executables, resolved once so that each
+# action does not walk `PATH` again. `posix_spawn` does not search `PATH`, so
+# fall back to the usual install location if they can't be found.
+SCANIMAGE = shutil.which( "scanimage" ) or "/usr/bin/scanimage"
+LP = shutil.which( "lp" ) or "/usr/bin/lp"
+
+# Command lines for the scan and print actions. These are built once and passed
+# directly to the child process, so no intermediate shell is forked per action.
+SCAN_ARGV = ( SCANIMAGE, "--device-name={}".format( SCANNER_DEVICE_NAME ),
+  "--format=jpeg", "--calibrate=Always" )
+PRINT_ARGV = ( LP, OUT_FILE )
+
+# Log records are put on this queue by the server and worker processes, and
+# written to stdout by a listener thread, keeping console I/O off the OSC path.
+# Set per process by `init_logging`.
+LOG_QUEUE = None
+
+logger = logging.getLogger( "larpa" )
+logger.setLevel( logging.INFO )
+logger.propagate = False
+
+# The last /echo message received, with its client address. A repeat from the
+# same client, such as a TouchOSC beacon, is not printed again.
+LAST_ECHO = None
+
+# Scan requests that arrive within this many seconds of the last accepted one
+# are dropped silently, e.g. an accidental double-tap in TouchOSC.
+DEBOUNCE_S = 2.0
+
+# Monotonic timestamp of the last accepted scan request.
+LAST_TRIGGER_TS = 0.0
+
+# The number of jobs that may be queued or running at once. Requests beyond this
+# are ignored. A value of 1 means we only attempt to scan/print once-at-a-time.
+MAX_PENDING_JOBS = 1
+
+# Seconds to wait before restarting a job worker process that has died, so that
+# one failing on start does not restart in a tight loop.
+WORKER_RESTART_DELAY_S = 1.0
+
+# Scan/print jobs queued by the OSC callbacks, and passed on to the job worker
+# process by `forward_jobs`. Created by `start_handler` and set per receiver
+# process by `init_jobs`.
+JOB_QUEUE = None
+
+# Counts the job slots left, up to `MAX_PENDING_JOBS`. The OSC server acquires
+# a slot when it queues a job and the worker process releases it once the job
+# has finished. Set alongside `JOB_QUEUE`.
+JOB_SLOTS = None
+
+# The pipe that jobs are sent to the current job worker process on. Only set in
+# the server process, by `start_job_worker`.
+WORKER_CONN = None
+
+
+# ===================================================================== Logging
+
+def init_logging( log_queue ):
+  """ Routes this process's log records to `log_queue`. Each child process calls
+  this on start, as it may not have inherited the parent's handler. """
+  global LOG_QUEUE
+  LOG_QUEUE = log_queue
+  logger.handlers = [ QueueHandler( log_queue ) ]
 
 
 # ============================================================= Device Commands
 
+# Flags for opening a child's stdout file, which it then writes to directly.
+STDOUT_FLAGS = os.O_WRONLY | os.O_CREAT | os.O_TRUNC
+
+def spawn_and_wait( argv, stdout_path=None ):
+  """ Runs `argv` to completion. If `stdout_path` is given, the child's stdout is
+  written to that file. Uses `posix_spawn` where available to avoid copying the
+  parent's address space on fork, falling back to `subprocess`. The child always
+  gets the default SIGINT handler, even though the job worker ignores it. """
+  if not hasattr( os, "posix_spawn" ):
+    kwargs = { "preexec_fn": restore_sigint } if os.name == "posix" else {}
+    if stdout_path is None:
+      subprocess.run( argv, check=False, **kwargs )
+    else:
+      fd = os.open( stdout_path, STDOUT_FLAGS, 0o644 )
+      try:
+        subprocess.run( argv, stdout=fd, check=False, **kwargs )
+      finally:
+        os.close( fd )
+    return
+
+  file_actions = []
+  if stdout_path is not None:
+    file_actions.append( ( os.POSIX_SPAWN_OPEN, 1, stdout_path, STDOUT_FLAGS, 0o644 ) )
+  pid = os.posix_spawn( argv[0], argv, os.environ, file_actions=file_actions,
+    setsigdef=( signal.SIGINT, ) )
+  os.waitpid( pid, 0 )
+
+def restore_sigint():
+  """ Restores the default SIGINT handler in a child about to exec. """
+  signal.signal( signal.SIGINT, signal.SIG_DFL )
+
+def open_scanner():
+  """ Opens `SCANNER_DEVICE_NAME` through SANE, if available, so that later
+  scans skip device discovery. Scans fall back to `scanimage` otherwise. """
+  global SCANNER
+  if sane is None:
+    return
+  # SaneDev.scan() needs Pillow, which python-sane does not depend on.
+  if importlib.util.find_spec( "PIL" ) is None:
+    logger.error( "> Pillow is not installed, using scanimage..." )
+    return
+  try:
+    sane.init()
+    SCANNER = sane.open( SCANNER_DEVICE_NAME )
+    if "calibrate" in SCANNER.opt:
+      SCANNER.calibrate = "Always"
+  except Exception as e:
+    logger.error( "> Unable to open scanner, using scanimage: {}".format( e ) )
+    close_scanner()
+
+def close_scanner():
+  """ Closes the SANE scanner, if open, and shuts SANE down, so that later scans
+  use `scanimage`. """
+  global SCANNER
+  try:
+    if SCANNER is not None:
+      SCANNER.close()
+    sane.exit()
+  except Exception:
+    pass
+  SCANNER = None
+
 def execute_scan():
   """ Executes a scan command. """
-  print( "> Scanning..." )
-  subprocess.run( "scanimage --device-name={} --format=jpeg --calibrate=Always > {}".format( SCANNER_DEVICE_NAME, OUT_FILE ), shell=True )
+  logger.info( "> Scanning..." )
+  if SCANNER is not None:
+    try:
+      SCANNER.scan().save( OUT_FILE, "JPEG" )
+      return
+    except Exception as e:
+      logger.error( "> SANE scan failed, using scanimage: {}".format( e ) )
+      close_scanner()
+  spawn_and_wait( SCAN_ARGV, stdout_path=OUT_FILE )
 
 def execute_print():
   """ Executes a print command. Be sure to set a printer as the default in
   system settings """
-  print( "> Printing..." )
-  subprocess.run( "lp {}".format( OUT_FILE ), shell=True )
+  logger.info( "> Printing..." )
+  spawn_and_wait( PRINT_ARGV )
 
 
 # ====================================================== OSC Callback Functions
 
-def echo_callback( _address, msg ):
-  """ Prints the contents of the OSC message to the console. """
-  print( "> {}".format( msg ) )
-
-def scan_callback( _address, _msg ):
-  """ Prints the contents of the OSC message to the console. """
-  if MUTEX.locked():
-    print( "> Scan ignored, a process lock has already been acquired..." )
-  else:
-    with MUTEX:
-      execute_scan()
-
-def scan_and_print_callback( _address, _msg ):
-  if MUTEX.locked():
-    print( "> Scan and print ignored, a process lock has already been acquired..." )
-  else:
-    with MUTEX:
-      execute_scan()
-      execute_print()
+def echo_callback( client_address, _address, msg ):
+  """ Prints the contents of the OSC message to the console, unless it repeats
+  the previous message and came from the same client. """
+  global LAST_ECHO
+  if LAST_ECHO == ( client_address, msg ):
+    return
+  LAST_ECHO = ( client_address, msg )
+  logger.info( "> {}".format( msg ) )
+
+def is_debounced():
+  """ Returns True if a scan request was accepted within the last `DEBOUNCE_S`
+  seconds. Otherwise, records the current request and returns False. """
+  global LAST_TRIGGER_TS
+  now = time.monotonic()
+  if now - LAST_TRIGGER_TS < DEBOUNCE_S:
+    return True
+  LAST_TRIGGER_TS = now
+  return False
+
+def scan_callback( _client_address, _address, _msg ):
+  """ Queues a scan, unless the job queue is full. """
+  if is_debounced():
+    return
+  if not JOB_SLOTS.acquire( block=False ):
+    logger.info( "> Scan ignored, the job queue is full..." )
+    return
+  JOB_QUEUE.put_nowait( ( execute_scan, ) )
+
+def scan_and_print_callback( _client_address, _address, _msg ):
+  """ Queues a scan followed by a print, unless the job queue is full. """
+  if is_debounced():
+    return
+  if not JOB_SLOTS.acquire( block=False ):
+    logger.info( "> Scan and print ignored, the job queue is full..." )
+    return
+  JOB_QUEUE.put_nowait( ( execute_scan, execute_print ) )
+
+# OSC addresses served by the OSC server, and the callback for each.
+ROUTES = {
+  "/echo": echo_callback,
+  "/scan": scan_callback,
+  "/scan_and_print": scan_and_print_callback,
+}
+
+
+# ================================================================== Job Worker
+
+def init_jobs( job_queue, job_slots ):
+  """ Sets the job queue and slots that this process's OSC callbacks use. Each
+  receiver process calls this on start, so that all of them share one worker. """
+  global JOB_QUEUE, JOB_SLOTS
+  JOB_QUEUE = job_queue
+  JOB_SLOTS = job_slots
+
+def job_worker( job_conn, job_slots, log_queue ):
+  """ Runs queued jobs one at a time, for the lifetime of the server. Each job
+  is a sequence of device commands. Runs in its own process, so that the OSC
+  server is never blocked by a scan. """
+  # Ctrl+C is handled by the server process, which takes this one down with it.
+  signal.signal( signal.SIGINT, signal.SIG_IGN )
+  # The server terminates this process on exit. Unwind, so the scanner is closed.
+  signal.signal( signal.SIGTERM, lambda *_: sys.exit() )
+  init_logging( log_queue )
+  open_scanner()
+  try:
+    while True:
+      try:
+        job = job_conn.recv()
+      except EOFError:
+        return
+      try:
+        for command in job:
+          command()
+      except Exception as e:
+        logger.error( "> Job failed: {}".format( e ) )
+      finally:
+        try:
+          job_slots.release()
+        except ValueError:
+          # Already returned by `reset_job_slots` after a previous worker died.
+          pass
+  finally:
+    if SCANNER is not None:
+      close_scanner()
+
+def reset_job_slots():
+  """ Returns every job slot, including those held by jobs that a dead worker
+  will never finish. """
+  while True:
+    try:
+      JOB_SLOTS.release()
+    except ValueError:
+      return
+
+def start_job_worker():
+  """ Starts a job worker process and points `WORKER_CONN` at its pipe. Each
+  worker gets its own pipe, so that a worker that is killed can't leave a lock
+  shared with its replacement held. """
+  global WORKER_CONN
+  reader, writer = multiprocessing.Pipe( duplex=False )
+  worker = multiprocessing.Process( target=job_worker,
+    args=( reader, JOB_SLOTS, LOG_QUEUE ), daemon=True )
+  worker.start()
+  # Only the worker may hold the read end, so that sends fail once it's gone.
+  reader.close()
+  WORKER_CONN = writer
+  return worker
+
+def forward_jobs():
+  """ Passes jobs from `JOB_QUEUE` to the current job worker. Runs on a thread in
+  the server process, so that the queue's shared read lock is never held by a
+  worker process that might be killed. """
+  while True:
+    job = JOB_QUEUE.get()
+    try:
+      WORKER_CONN.send( job )
+    except OSError:
+      # The worker has died. Its slots are returned when it is restarted.
+      pass
+
+def supervise_job_worker( worker, stopping ):
+  """ Restarts the job worker process whenever it dies, until `stopping` is
+  set. Runs on a thread in the server process, so that a crashed worker can't
+  leave scans rejected until the server is restarted. """
+  while True:
+    worker.join()
+    if stopping.is_set():
+      return
+    logger.error( "> Job worker exited with code {}, restarting...".format( worker.exitcode ) )
+    if stopping.wait( WORKER_RESTART_DELAY_S ):
+      return
+    worker = start_job_worker()
+    # Jobs sent to the dead worker are dropped, so return their slots. This is
+    # done after the new worker takes over, so no job can be dropped later.
+    reset_job_slots()
+
+
+# ================================================================== OSC Server
+
+class RouteDispatcher( Dispatcher ):
+  """ An OSC dispatcher that resolves literal addresses with a single dict
+  lookup, only falling back to python-osc's pattern matching for addresses that
+  don't match a route exactly, e.g. wildcards. Callbacks are passed the client
+  address ahead of the OSC address. """
+
+  def __init__( self, routes ):
+    super().__init__()
+    for address, callback in routes.items():
+      self.map( address, callback, needs_reply_address=True )
+
+  def handlers_for_address( self, address_pattern ):
+    return self._map.get( address_pattern ) or super().handlers_for_address( address_pattern )
+
+def bind_osc_socket( host, port ):
+  """ Creates a non-blocking UDP socket bound to `( host, port )`, shared by
+  every OSC receiver process. """
+  sock = socket.socket( socket.AF_INET, socket.SOCK_DGRAM )
+  sock.setsockopt( socket.SOL_SOCKET, socket.SO_RCVBUF, OSC_SERVER_RCVBUF )
+  sock.setblocking( False )
+  sock.bind( ( host, port ) )
+  return sock
+
+def drain_socket( loop, sock, dispatcher ):
+  """ Dispatches the datagrams already queued on `sock`, up to
+  `OSC_MAX_READS_PER_WAKE`, rather than one per event loop wake. """
+  for _ in range( OSC_MAX_READS_PER_WAKE ):
+    try:
+      data, client_address = sock.recvfrom( OSC_MAX_PACKET_SIZE )
+    except BlockingIOError:
+      return
+    dispatch_packet( loop, dispatcher, data, client_address )
+
+def dispatch_packet( loop, dispatcher, data, client_address ):
+  """ Dispatches each message in an OSC packet. Messages in a bundle timed for
+  the future are scheduled on `loop`, rather than slept on as python-osc does,
+  so that they don't hold up the messages behind them. """
+  try:
+    packet = OscPacket( data )
+  except ( ParseError, UnicodeDecodeError ):
+    return
+  except Exception:
+    logger.exception( "> Failed to parse OSC packet from {}".format( client_address ) )
+    return
+  now = time.time()
+  for timed_msg in packet.messages:
+    delay = timed_msg.time - now
+    if delay > 0:
+      loop.call_later( delay, dispatch_message, dispatcher, client_address, timed_msg.message )
+    else:
+      dispatch_message( dispatcher, client_address, timed_msg.message )
+
+def dispatch_message( dispatcher, client_address, message ):
+  """ Invokes the handlers for a single OSC message. """
+  try:
+    for handler in dispatcher.handlers_for_address( message.address ):
+      handler.invoke( client_address, message )
+  except Exception:
+    logger.exception( "> Failed to handle OSC message from {}".format( client_address ) )
+
+def serve_osc( sock, dispatcher ):
+  """ Serves OSC messages arriving on `sock` from an asyncio event loop, until
+  interrupted. """
+  loop = asyncio.new_event_loop()
+  loop.add_reader( sock, drain_socket, loop, sock, dispatcher )
+  try:
+    loop.run_forever()
+  finally:
+    loop.close()
+
+def serve_receiver( sock, job_queue, job_slots, log_queue ):
+  """ Runs an additional OSC receiver in its own process. """
+  # Ctrl+C is handled by the main server process, which takes this one down
+  # with it.
+  signal.signal( signal.SIGINT, signal.SIG_IGN )
+  init_logging( log_queue )
+  init_jobs( job_queue, job_slots )
+  serve_osc( sock, RouteDispatcher( ROUTES ) )
 
 
 # ================================================================ CLI Handlers
@@ -107,20 +488,37 @@ def scan_and_print_callback( _address, _msg ):
 def start_handler( args ):
   """ CLI handler for the start subparser. Starts an OSC server with the
   defined routes."""
-  dispatcher = Dispatcher()
-  dispatcher.map( "/echo", echo_callback )
-  dispatcher.map( "/scan", scan_callback )
-  dispatcher.map( "/scan_and_print", scan_and_print_callback )
+  init_jobs( multiprocessing.Queue(), multiprocessing.BoundedSemaphore( MAX_PENDING_JOBS ) )
 
-  server = ThreadingOSCUDPServer( ( args.host, args.port ), dispatcher )
-  print( "Serving on {}...".format( server.server_address ) )
-  server.serve_forever()
+  sock = bind_osc_socket( args.host, args.port )
+  for _ in range( OSC_SERVER_RECEIVERS - 1 ):
+    multiprocessing.Process( target=serve_receiver,
+      args=( sock, JOB_QUEUE, JOB_SLOTS, LOG_QUEUE ), daemon=True ).start()
+
+  stopping = Event()
+  worker = start_job_worker()
+  Thread( target=forward_jobs, daemon=True ).start()
+  Thread( target=supervise_job_worker, args=( worker, stopping ), daemon=True ).start()
+
+  logger.info( "Serving on {}...".format( sock.getsockname() ) )
+  try:
+    serve_osc( sock, RouteDispatcher( ROUTES ) )
+  finally:
+    stopping.set()
 
 def echo_handler( args ):
   """ CLI handler for the echo subparser. Emits a message to the /echo 
   receiver. """
-  client = SimpleUDPClient( args.host, args.port )
-  client.send_message( "/echo", args.msg )
+  global ECHO_SOCKET
+  msg = args.msg.encode( "utf-8" )
+  padding = b"\x00" * ( 4 - len( msg ) % 4 )
+  family, type_, proto, _, address = socket.getaddrinfo(
+    args.host, args.port, type=socket.SOCK_DGRAM )[0]
+  if ECHO_SOCKET is None or ECHO_SOCKET.family != family:
+    if ECHO_SOCKET is not None:
+      ECHO_SOCKET.close()
+    ECHO_SOCKET = socket.socket( family, type_, proto )
+  ECHO_SOCKET.sendto( ECHO_PREFIX + msg + padding, address )
 
 def scan_handler( args ):
   """ CLI handler for the scan subparser. Will execute a scanning action. """
@@ -171,4 +569,11 @@ if __name__ == "__main__":
   scan_and_print_parser.set_defaults( func=scan_and_print_handler )
 
   args = parser.parse_args()
-  args.func( args )
\ No newline at end of file
+
+  init_logging( multiprocessing.Queue() )
+  log_listener = QueueListener( LOG_QUEUE, logging.StreamHandler( sys.stdout ) )
+  log_listener.start()
+  try:
+    args.func( args )
+  finally:
+    log_listener.stop()
\ No newline at end of file